@@ -13,13 +13,16 @@ import datetime
 import tkinter as tk
 import matplotlib.pyplot as plt
 import os
+import collections
+import queue
+import logging
 
 # import matplotlib as mpl
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 
 # import equipment modules
-import pack_Pfieffer_TPG261
+import mod_Pfieffer_TPG261
 
 
 # plot config
@@ -35,6 +38,9 @@ plt.rcParams['lines.markersize'] = 2
 figsize_x = 5
 figsize_y = 3
 
+# record layout of the logged data (saved as is with np.save)
+data_dtype = np.dtype([('abs_time', 'datetime64[us]'), ('t', 'f8'), ('state', 'U16'), ('P', 'f8')])
+
 
 ################################################################################################
 ################################################################################################
@@ -58,6 +64,12 @@ class TPG261_GUI(tk.Frame):
 
         self.plot_limits = tk.StringVar(master, 'full')  # for radio buttons in plot window
         self.plot_dt = tk.IntVar(master, 10) # plot delta time for scroll option
+        
+        # plot refresh is limited to 5 Hz, the axes are only redrawn when the limits change
+        self.draw_period = 0.2  # seconds
+        self._last_draw = 0
+        self._last_lim = None
+        self._bg = None  # axes background for blitting the pressure line
                 
         ####################
         ### Plot Display ###
@@ -74,8 +86,9 @@ class TPG261_GUI(tk.Frame):
         self.ax.set_ylabel('Pressure (Torr)')
 #        self.ax.set_yscale('log')
         
-        self.pressure_plot, = self.ax.plot(self.Data.time_list, self.Data.P_list, 'o-', label='Pressure')
+        self.pressure_plot, = self.ax.plot(self.Data.T[:self.Data.idx], self.Data.P[:self.Data.idx], 'o-', label='Pressure', animated=True)
         self.canvas = FigureCanvasTkAgg(self.f, self.frame['Plot'])
+        self.canvas.mpl_connect('draw_event', self._on_draw)
         self.canvas.draw()
         self.canvas.get_tk_widget().grid(row=0, column=0, columnspan=4, padx=10, pady=5)
         
@@ -140,36 +153,74 @@ class TPG261_GUI(tk.Frame):
         
     def _update(self, plotdata='pressure'):
         """ Update Plots """
-        # This is the lower limit of the pfieffer gauge
-        ylim_low = 7.5e-10 + 0.3 * 7.5e-10  # the 0.3 is the STD
-        ylim_low = 0.9*np.nanmin(self.Data.P_list)
+        now = time.monotonic()
+        if now - self._last_draw < self.draw_period:
+            return
+        self._last_draw = now
+        
+        # views of the filled part of the data buffers
+        n = self.Data.idx
+        T = self.Data.T[:n]
+        P = self.Data.P[:n]
+        
+        # data extremes, computed once per frame (time only increases)
+        t_min, t_max = T[0], T[n - 1]
+        p_min, p_max = np.nanmin(P), np.nanmax(P)
+        ylim_low = 0.9*p_min
         
         # Update Plot Data
         if plotdata == 'pressure':
-            self.pressure_plot.set_xdata(self.Data.time_list) 
-            self.pressure_plot.set_ydata(self.Data.P_list)
-    
-            # Update Plot Limits
-            x_min = 0.9 * min(self.Data.time_list)
-            x_max = 1.1 * max(self.Data.time_list)
-            self.ax.set_xlim(x_min, x_max)
+            self.pressure_plot.set_data(T, P)
     
-            if self.plot_limits.get() == 'full':
-                self.ax.set_yscale('linear')
-                self.ax.set_xlim(0.9*np.nanmin(self.Data.time_list), 1.1*np.nanmax(self.Data.time_list))
-                self.ax.set_ylim(ylim_low, 1.1 * np.nanmax(self.Data.P_list))
+            # Plot Limits
+            x_min = 0.9 * t_min
+            x_max = 1.1 * t_max
+            mode = self.plot_limits.get()
+            yscale = self.ax.get_yscale()  # Delta T keeps the current scale
+            ylim_high = 1.1 * p_max
             
-            elif self.plot_limits.get() == 'dt':
+            if mode == 'full':
+                yscale = 'linear'
+            
+            elif mode == 'dt':
                 a = self.plot_dt.get()  # how many data points back in time
-                self.ax.set_xlim(max(self.Data.time_list) - a, x_max)
-                self.ax.set_ylim(ylim_low, 1.1 * np.nanmax(self.Data.P_list[-60 * a:]))
+                x_min = t_max - a
+                if self.Data.win_len != 60 * a:
+                    self.Data.set_window(60 * a)
+                ylim_high = 1.1 * self.Data.current_max()
             
-            elif self.plot_limits.get() == 'log10':
-                self.ax.set_yscale('log')
-                self.ax.set_ylim(ylim_low, 1000 * np.nanmax(self.Data.P_list))
-    
-            self.f.tight_layout()
-            self.canvas.draw()
+            elif mode == 'log10':
+                yscale = 'log'
+                ylim_high = 1000 * p_max
+            
+            lim = (yscale, x_min, x_max, ylim_low, ylim_high)
+            if self._bg is None or self._limits_changed(lim):
+                # new axes, redo the layout and redraw everything (background is saved in _on_draw)
+                self.ax.set_yscale(yscale)
+                self.ax.set_xlim(x_min, x_max)
+                self.ax.set_ylim(ylim_low, ylim_high)
+                self.f.tight_layout()
+                self.canvas.draw_idle()
+            else:
+                # the limits have head room, only repaint the line over the saved axes
+                self.canvas.restore_region(self._bg)
+                self.ax.draw_artist(self.pressure_plot)
+                self.canvas.blit(self.ax.bbox)
+            
+    def _on_draw(self, event):
+        """ Saves the axes background after a full redraw and paints the animated line on it """
+        self._bg = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.pressure_plot)
+            
+    def _limits_changed(self, lim, tol=0.01):
+        """ True if the axis scale or any limit moved by more than tol (relative) since they were last applied """
+        last = self._last_lim
+        
+        if (last is None or last[0] != lim[0]
+                or any(abs(new - old) > tol * abs(old) for new, old in zip(lim[1:], last[1:]))):
+            self._last_lim = lim
+            return True
+        return False
                 
             
 class Data_Structure_TPG261:
@@ -193,27 +244,72 @@ class Data_Structure_TPG261:
                 self.read_only[key] = tk.DoubleVar()
                 self.input_var[key] = tk.DoubleVar()
                 
-        # plot arrays and data storage
-        self.abs_time_list = [] # date time stamp
-        self.time_list = []
-        self.P_list = []
-        self.state_list = []
+        # preallocated data storage filled up to idx, T (minutes) and P are views used for plotting
+        self.cap = 86400
+        self.buf = self._alloc(self.cap)
+        self.T = self.buf['t']
+        self.P = self.buf['P']
+        self.idx = 0
+        
+        # running maximum of the last win_len pressures for the Delta T plot, resized by set_window
+        self.win_len = 60 * 10
+        self._win_max = collections.deque()  # (pressure, index), decreasing pressure
 
         
-    def data_update(self):
-        """ Append Data to Lists"""
-        
-        self.abs_time_list.append(datetime.datetime.now())
-        self.time_list.append((time.time()-self.start_time)/60)
-        self.P_list.append(self.read_only['pressure'].get())
-        self.state_list.append(self.read_only['state'].get())
+    def data_update(self, ts):
+        """ Write Data to the next record of the buffer, ts is the time.time() of the reading"""
+        if self.idx == self.cap:
+            self._grow()
+        
+        i = self.idx
+        self.buf[i] = (np.datetime64(datetime.datetime.fromtimestamp(ts), 'us'),
+                       (ts-self.start_time)/60,
+                       self.read_only['state'].get(),
+                       self.read_only['pressure'].get())
+        self._push_win_max(self.P[i], i)
+        self.idx += 1
+        
+    def _push_win_max(self, value, i):
+        """ Adds a pressure to the running maximum, NaN is skipped like np.nanmax """
+        if not np.isnan(value):
+            while self._win_max and self._win_max[-1][0] <= value:
+                self._win_max.pop()
+            self._win_max.append((value, i))
+        
+        # drop the entries that left the window
+        while self._win_max and self._win_max[0][1] <= i - self.win_len:
+            self._win_max.popleft()
+            
+    def set_window(self, window):
+        """ Rebuilds the running maximum for the last window data points """
+        self.win_len = window
+        self._win_max.clear()
+        for i in range(max(0, self.idx - window), self.idx):
+            self._push_win_max(self.P[i], i)
+            
+    def current_max(self):
+        """ Maximum pressure of the last win_len data points """
+        # the deque is decreasing, so the front entry is the maximum of the window
+        return self._win_max[0][0] if self._win_max else np.nan
+        
+    @staticmethod
+    def _alloc(n):
+        """ Empty records with NaN time and pressure """
+        buf = np.empty(n, dtype=data_dtype)
+        buf['t'] = np.nan
+        buf['P'] = np.nan
+        return buf
+        
+    def _grow(self):
+        """ Doubles the size of the buffer once it is full """
+        self.buf = np.concatenate((self.buf, self._alloc(self.cap)))
+        self.T = self.buf['t']
+        self.P = self.buf['P']
+        self.cap *= 2
         
     def save_prep(self):
-        """ Prepare Data for Saving """
-        SaveData = np.vstack((self.abs_time_list, self.time_list, self.state_list, self.P_list))
-        SaveData = np.transpose(SaveData)
-        
-        return SaveData         
+        """ Prepare Data for Saving, one record per data point """
+        return self.buf[:self.idx]
     
 #--------------------------------------------------------------------------------------------------------      
 
@@ -222,6 +318,9 @@ class Data_Structure_TPG261:
 ####################
         
 if __name__=='__main__':    
+    # controller messages: warnings (failed reads) on the console, per reading status stays quiet
+    logging.basicConfig(level=logging.WARNING)
+    
     root = tk.Tk()
     root.title('TPG261 Pfeiffer Vacuum Single Gauge')
     
@@ -274,7 +373,7 @@ if __name__=='__main__':
     TPG261_data = Data_Structure_TPG261('Pfieffer TPG261 Single Gauge', dt, t0)
     
     # TPG261 Pressure Controller
-    TPG261 = pack_Pfieffer_TPG261.pfieffer_single_gauge_TPG261(ports['TPG261'])
+    TPG261 = mod_Pfieffer_TPG261.pfieffer_single_gauge_TPG261(ports['TPG261'])
     TPG261_data.read_only['pressure'].set(TPG261.get_pressure(gauge=1)[1])
     TPG261_data.read_only['state'].set(TPG261.get_pressure(gauge=1)[0])
     TPG261_data.read_only['sensor1'].set(TPG261.get_gauge_type()[0])
@@ -290,16 +389,22 @@ if __name__=='__main__':
     # waiting for all controllers to be ready
     expected_controllers = ['Substrate_Controller', 'TPG261_Controller', 'MKS_Pressure_Controller', 'BKP_Arb_Waveform_Controller']
     ready = False
+    last_stat = None
+    print('Waiting for all controllers to be ready')
     
     while not ready:
-        with open('controller_ready.txt', 'r') as f:
-            lines = f.readlines()
+        # only re-read the file when another controller has written to it
+        st = os.stat('controller_ready.txt')
+        if (st.st_mtime_ns, st.st_size) != last_stat:
+            last_stat = (st.st_mtime_ns, st.st_size)
             
-        ready = all(f'{controller} is ready\n' in lines for controller in expected_controllers)
+            with open('controller_ready.txt', 'r') as f:
+                lines = f.readlines()
+                
+            ready = all(f'{controller} is ready\n' in lines for controller in expected_controllers)
         
         if not ready:
-            print('Waiting for all controllers to be ready')
-            time.sleep(0.01)
+            time.sleep(0.1)
             
     
 #### End new code ######      
@@ -350,11 +455,16 @@ if __name__=='__main__':
     ###### TPG 261 Cont  ############    
     ################################# 
     
+    # CAL writes both gauges, so both displayed factors are updated from its reply
     def set_Calibration_TPG261_gauge1(cont_TPG216, data):
-        cont_TPG216.set_calibration_factor(1, data.input_var['cal_g1'].get())
+        cal_g1, cal_g2 = cont_TPG216.set_calibration_factor(1, data.input_var['cal_g1'].get())
+        data.read_only['cal_g1'].set(cal_g1)
+        data.read_only['cal_g2'].set(cal_g2)
         
     def set_Calibration_TPG261_gauge2(cont_TPG216, data):
-        cont_TPG216.set_calibration_factor(2, data.input_var['cal_g2'].get())
+        cal_g1, cal_g2 = cont_TPG216.set_calibration_factor(2, data.input_var['cal_g2'].get())
+        data.read_only['cal_g1'].set(cal_g1)
+        data.read_only['cal_g2'].set(cal_g2)
         
         
     TPG261_data.input_var['cal_g1'].trace('w', lambda a, b, c: set_Calibration_TPG261_gauge1(TPG261, TPG261_data))
@@ -362,30 +472,45 @@ if __name__=='__main__':
     
     
     # Update Loop
-    def update(t0):
+    def update():
         """ updates the data values after a pre-set time dt"""       
+        tick_start = time.monotonic()
+        
+        # drain the readings from the TPG261 poll thread without blocking the GUI
+        new_data = False
+        while True:
+            try:
+                pressure, state, ts = TPG261.readings.get_nowait()
+            except queue.Empty:
+                break
+            
+            TPG261_data.read_only['pressure'].set(pressure)
+            TPG261_data.read_only['state'].set(state)
+            
+            # Append to Data lists
+            TPG261_data.data_update(ts)
+            Data_Num.set(Data_Num.get() + 1)
+            new_data = True
         
-        # update the TPG261 Controller
-        TPG261_data.read_only['pressure'].set(TPG261.get_pressure(gauge=1)[1])
-        TPG261_data.read_only['state'].set(TPG261.get_pressure(gauge=1)[0])
-        TPG261_data.read_only['cal_g1'].set(TPG261.get_calibration_factor()[0])
-        TPG261_data.read_only['cal_g2'].set(TPG261.get_calibration_factor()[1])
-        
-        # Append to Data lists
-        TPG261_data.data_update()
+        # the poll thread stopped on a serial error, the values above are no longer updated
+        if TPG261.poll_error is not None:
+            TPG261_data.read_only['state'].set('Serial error, stopped')
         
         # Update plots
-        GUI['TPG261']._update()
+        if new_data:
+            GUI['TPG261']._update()
         
-        # Update Clock and Data Point Counter
+        # Update Clock
         Clock.set(str((time.time()-t0)/60)[:-10])
-        Data_Num.set(Data_Num.get() + 1)
         
-        # Continue Loop
-        root.after(dt, lambda: update(t0)) 
+        # Continue Loop, the time spent in this tick counts towards dt
+        elapsed_ms = int((time.monotonic() - tick_start) * 1000)
+        root.after(max(0, dt - elapsed_ms), update) 
         
         
-    root.after(0, lambda: update(t0))
+    # serial reads run in a background thread, update() only drains the readings
+    TPG261.start_polling(gauge=1, interval=dt/1000)
+    root.after(0, update)
     
     # Start main Loop
     
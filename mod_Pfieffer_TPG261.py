@@ -6,8 +6,18 @@ Created on Thu Oct 17 12:31:50 2024
 Interfaces with the TPG261 Single gauge pressure controller
 """
 
+import sys
+import time
+import queue
+import threading
+import functools
+import logging
 import serial 
 
+# silent unless the application configures logging
+log = logging.getLogger('tpg261')
+log.addHandler(logging.NullHandler())
+
 CR = bytearray(b'\x0d')
 LF = bytearray(b'\x0a')
 ETX = bytearray(b'\x03')
@@ -15,13 +25,51 @@ ENQ = bytearray(b'\x05')
 ACK = bytearray(b'\x06')
 NAK = bytearray(b'\x15')
 
+# command frames used in the polling loop, built once
+_CRLF = b'\r\n'
+_PR = {1: b'PR1\r\n', 2: b'PR2\r\n'}
+_TID = b'TID\r\n'
+_CAL_QUERY = b'CAl\r\n'
+
+# status codes sent with a pressure reading
+_STATUS = {
+    0: 'Passed',
+    1: 'Underrange',
+    2: 'Overrange', 
+    3: 'Sensor Error',
+    4: 'Sensor off',
+    5: 'No Sensor',
+    6: 'ID Error'
+}
+
+def _parse_status_value(line):
+    '''Splits a "status,value" reply into the integer status and the float pressure'''
+    status, value = line.split(',')
+    return int(status), float(value)
+
+@functools.lru_cache(maxsize=64)
+def _frame(payload):
+    '''Encodes a command with its CR LF terminator, cached per distinct command'''
+    return payload.encode('ascii') + b'\r\n'
+
 class PfeifferException(Exception):
     pass
 
 class pfieffer_single_gauge_TPG261:
     '''Class to interface with the TPG261 pfieffer single gauge vacuum controller'''
 
-    def __init__(self, port, baudrate=9600):
+    def __init__(self, port, baudrate=9600, pipeline=False):
+        # send the ENQ together with the command, dropped if the controller does not answer it.
+        # Off by default: not yet verified on a TPG261 that the early ENQ is answered with the new
+        # command's data and not the previous one's
+        self.pipeline = pipeline
+        # serializes access to the port between the poll thread and the GUI
+        self._lock = threading.Lock()
+        # bytes received after the last complete frame
+        self._rxbuf = bytearray()
+        self._thr = None
+        # set to the exception that stopped the poll thread
+        self.poll_error = None
         self.ser = serial.Serial(
             port=port,  # <-- Pass port here
             baudrate=baudrate,
@@ -30,93 +78,113 @@ class pfieffer_single_gauge_TPG261:
             stopbits=serial.STOPBITS_ONE,
             timeout=1  # Add timeout to prevent hangs
         )
+        self._set_low_latency()
         self.set_filter()
         self.set_calibration_factor(1, 1)
         self.set_calibration_factor(2, 1)
         self.set_display_resolution()
         
-    def get_pressure(self, gauge):
-        '''Sets the pressure for Gauge 1 and returns the pressure for gauge 1'''
-        messages = {
-            0: 'Passed',
-            1: 'Underrange',
-            2: 'Overrange', 
-            3: 'Sensor Error',
-            4: 'Sensor off',
-            5: 'No Sensor',
-            6: 'ID Error'
-        }
+    def _set_low_latency(self):
+        '''Reduces the USB-serial adapter buffering delay (FTDI latency timer) where the driver allows it'''
+        try:
+            if sys.platform.startswith('linux'):
+                # sets ASYNC_LOW_LATENCY on the tty through TIOCSSERIAL
+                self.ser.set_low_latency_mode(True)
+            elif sys.platform == 'win32':
+                self.ser.set_buffer_size(rx_size=4096, tx_size=4096)
+        except (AttributeError, OSError, ValueError, serial.SerialException):
+            # not every adapter supports it, keep the default latency
+            pass
+        
+    def _cmd(self, frame, error):
+        '''Sends a command frame, checks the acknowledgement and returns the reply string'''
+        with self._lock:
+            return self._exchange(frame, error)
         
-        # writes the pressure to gauge 1
-        self.ser.write(bytearray('PR%i' %gauge, 'ascii') + CR + LF)
-        line = self.ser.readline().strip()
+    def _exchange(self, frame, error):
+        if self.pipeline:
+            # command and data request in a single write
+            self.ser.write(frame + ENQ)
+        else:
+            self.ser.write(frame)
+        line = self._read_frame().strip()
         
         # see if the controller acknowledges
         if line != ACK:
-            raise PfeifferException('Error Sending "PR%i"' %gauge)
+            self.ser.reset_input_buffer()
+            self._rxbuf.clear()
+            raise PfeifferException(error)
             
-        # requests the information 
-        self.ser.write(ENQ)
-        line = self.ser.readline().strip().decode('utf-8')
-        status, value = line.split(",")
+        if not self.pipeline:
+            # requests the information 
+            self.ser.write(ENQ)
+        reply = self._read_frame()
+        
+        if self.pipeline and not reply.endswith(_CRLF):
+            # the early ENQ was ignored, fall back to the two write exchange
+            self.pipeline = False
+            self.ser.write(ENQ)
+            reply = self._read_frame()
+            
+        return reply.strip().decode('ascii')
+        
+    def _read_frame(self, terminator=_CRLF, timeout=0.2):
+        '''Returns the next frame including its terminator, or the bytes received before the timeout (s)'''
+        buf = self._rxbuf
+        timer = serial.Timeout(timeout)
+        
+        # read whatever is buffered as soon as it arrives instead of byte by byte
+        while terminator not in buf and not timer.expired():
+            n = self.ser.in_waiting
+            if n:
+                buf.extend(self.ser.read(n))
+            else:
+                time.sleep(0.0005)
+                
+        end = buf.find(terminator)
+        end = len(buf) if end < 0 else end + len(terminator)
+        frame = bytes(buf[:end])
+        del buf[:end]
+        return frame
+        
+    def get_pressure(self, gauge):
+        '''Sets the pressure for Gauge 1 and returns the pressure for gauge 1'''
+        # reads the pressure of the gauge
+        line = self._cmd(_PR[gauge] if gauge in _PR else _frame('PR%i' %gauge), 'Error Sending "PR%i"' %gauge)
+        status, value = _parse_status_value(line)
         
-        status = int(status)
         if status != 0:
-            print(messages[status])
+            log.info('Gauge %i: %s', gauge, _STATUS[status])
                
-        return messages[status], float(value)
+        return _STATUS[status], value
     
     def get_gauge_type(self):
         '''Returns the gauge type for sensor 1 and sensor 2'''
         
-        self.ser.write(bytearray('TID', 'ascii') + CR + LF)
-        line = self.ser.readline().strip()
-        
-        if line != ACK:
-            raise PfeifferException('Error sending "TID"')
-            
-        self.ser.write(ENQ)
-        line = self.ser.readline().strip().decode('utf-8')
+        line = self._cmd(_TID, 'Error sending "TID"')
         gauge_1, gauge_2 = line.split(',')
         
         return gauge_1, gauge_2
     
     def get_calibration_factor(self):
         '''Gets the Calibration Factor'''
-        self.ser.write(bytearray('CAl', 'ascii') + CR + LF)
-        line = self.ser.readline()
-              
-        self.ser.write(ENQ)
-        line = self.ser.readline().strip().decode('utf-8')
+        line = self._cmd(_CAL_QUERY, 'Error sending "CAl"')
         G1_cal, G2_cal = line.split(',')
         
         return G1_cal, G2_cal
     
     def set_calibration_factor(self, gauge, cal):
-        '''Changes the calibration factor for gauge 1 and guage 2'''
+        '''Changes the calibration factor for gauge 1 and guage 2.
+        CAL writes both gauges, returns the calibration factors of gauge 1 and gauge 2 sent back by the controller'''
         if gauge == 1:
-            self.ser.write(bytearray('CAL,%.3f,%.3f' %(cal, 1), 'ascii') + CR + LF)
-            line = self.ser.readline().strip()
-        
-            if line != ACK:
-                raise PfeifferException('Error sending Calibration factor')
-        
-            self.ser.write(ENQ)
-            line = self.ser.readline().strip().decode('utf-8')
+            line = self._cmd(_frame('CAL,%.3f,%.3f' %(cal, 1)), 'Error sending Calibration factor')
             G1_cal, G2_cal = line.split(',')
-            return G1_cal
+            return G1_cal, G2_cal
         
         if gauge == 2:
-            self.ser.write(bytearray('CAL,%.3f,%.3f' %(1, cal), 'ascii') + CR + LF)
-            line = self.ser.readline().strip()
-        
-            if line != ACK:
-                raise PfeifferException('Error sending Calibration factor')
-        
-            self.ser.write(ENQ)
-            line = self.ser.readline().strip().decode('utf-8')
+            line = self._cmd(_frame('CAL,%.3f,%.3f' %(1, cal)), 'Error sending Calibration factor')
             G1_cal, G2_cal = line.split(',')
-            return G2_cal
+            return G1_cal, G2_cal
     
     def set_units(self, unit=1):
         '''Changes the default units of the gauge to Torr
@@ -132,16 +200,11 @@ class pfieffer_single_gauge_TPG261:
             2: 'Pascal'
         }
         
-        self.ser.write(bytearray('UNI,%i' %unit, 'ascii') + CR + LF)
-        line = self.ser.readline().strip()
+        line = self._cmd(_frame('UNI,%i' %unit), 'Error changing units')
         
-        if line != ACK:
-            raise PfeifferException('Error changing units')
-            
-        self.ser.write(ENQ)
-        line = self.ser.readline().strip().decode('utf-8')
-        
-        return print(f'The TPG261 default units are set to {units[int(line)]}')
+        unit = units[int(line)]
+        log.info('The TPG261 default units are set to %s', unit)
+        return unit
     
     def set_filter(self, G1=1, G2=1):
         '''Sets the filter speed of each gauge. defaulting to medium'''
@@ -152,17 +215,12 @@ class pfieffer_single_gauge_TPG261:
             2: 'slow'
         }
         
-        self.ser.write(bytearray('FIL,%i,%i' %(G1, G2), 'ascii') + CR + LF)
-        line = self.ser.readline().strip()
-        
-        if line != ACK:
-            raise PfeifferException('Error changing the filter speed to fast')
-            
-        self.ser.write(ENQ)
-        line = self.ser.readline().strip().decode('utf-8')
+        line = self._cmd(_frame('FIL,%i,%i' %(G1, G2)), 'Error changing the filter speed to fast')
         gauge1, gauge2 = line.split(',')
         
-        return print(f'The TPG261 Filter speed for Gauge 1 is {Filter[int(gauge1)]} and for Gauge 2 is {Filter[int(gauge2)]}')
+        res = Filter[int(gauge1)], Filter[int(gauge2)]
+        log.info('The TPG261 Filter speed for Gauge 1 is %s and for Gauge 2 is %s', *res)
+        return res
     
     def set_display_resolution(self):
         '''Sets the default display resolution according to the values below. 
@@ -178,17 +236,50 @@ class pfieffer_single_gauge_TPG261:
             
         resolution = 3
             
-        self.ser.write(bytearray('DCD,%i' %resolution, 'ascii') + CR + LF)
-        line = self.ser.readline().strip()
+        res = self._cmd(_frame('DCD,%i' %resolution), 'Error in changing the display resolution')
         
-        if line !=ACK:
-            raise PfeifferException('Error in changing the display resolution')
+        res = Resolution[int(res)]
+        log.info('The display resolution has been set to %s.', res)
+        return res
         
-        self.ser.write(ENQ)
-        res = self.ser.readline().strip().decode('utf-8')
-        
-        return print(f'The display resolution has been set to {Resolution[int(res)]} digits.')
+            
+    def start_polling(self, gauge=1, interval=0.1):
+        '''Starts a background thread that reads the pressure every interval (s).
+        Readings are put in self.readings as (pressure, state, time stamp) tuples.
+        If the port fails the thread stops and the exception is kept in self.poll_error'''
+        self.readings = queue.Queue(maxsize=8)
+        self.poll_error = None
+        self._stop = threading.Event()
+        self._thr = threading.Thread(target=self._poll_loop, args=(gauge, interval), daemon=True)
+        self._thr.start()
         
+    def _poll_loop(self, gauge, interval):
+        while not self._stop.is_set():
+            try:
+                state, pressure = self.get_pressure(gauge)
+            except (PfeifferException, ValueError, KeyError) as e:
+                # a bad or unexpected reply, try again on the next cycle
+                log.warning('Pressure reading failed: %r', e)
+            except (serial.SerialException, OSError) as e:
+                # the port is gone (e.g. USB unplugged), stop polling and let the GUI report it
+                log.error('Serial port failed, polling stopped: %s', e)
+                self.poll_error = e
+                break
+            else:
+                msg = (pressure, state, time.time())
+                try:
+                    self.readings.put_nowait(msg)
+                except queue.Full:
+                    # drop the oldest reading if the GUI falls behind
+                    try:
+                        self.readings.get_nowait()
+                    except queue.Empty:
+                        pass
+                    self.readings.put_nowait(msg)
+            self._stop.wait(interval)
             
     def close(self):
+        if self._thr is not None:
+            self._stop.set()
+            self._thr.join()
         self.ser.close()
\ No newline at end of file